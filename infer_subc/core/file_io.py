@@ -1,6 +1,7 @@
 import numpy as np
 
 from platform import system
+import hashlib
 # import os
 # import pickle
 
@@ -15,7 +16,7 @@ from aicsimageio.writers import OmeTiffWriter
 from aicsimageio import AICSImage, exceptions
 
 # import ome_types
-from tifffile import imwrite, tiffcomment, imread
+from tifffile import imwrite, tiffcomment, imread, TiffFile
 import time
 
 # todo depricate wrapper
@@ -64,11 +65,15 @@ def export_tiff(
     out_path: Union[Path, str],
     channel_names: Union[List[str], None] = None,
     meta_in: Union[Dict, None] = None,
+    key: Union[str, None] = None,
 ) -> int:
     """
     wrapper for exporting  tiff with tifffile.imwrite
      --> usiong AICSimage is too slow
         prsumably handling the OME meta data is what is so slow.
+    key:
+        optional content key (see `content_key`) stored in the tiff's metadata and checked by
+        `import_inferred_organelle`
     """
 
     # start = time.time()
@@ -101,10 +106,16 @@ def export_tiff(
     # else:
         # print(f"export as {dtype}")
 
+    # masks and labels are mostly background and compress ~40x losslessly, which cuts disk i/o for batch runs.
+    #   (level is left at the default; tifffile changed how the zlib level is passed between versions)
+    compression = "zlib" if np.issubdtype(dtype, np.integer) else None
+
     ret = imwrite(
             out_name,
             data_in,
             dtype=dtype,
+            compression=compression,
+            metadata={} if key is None else {"content_key": key},
             # metadata={
             #     "axes": dimension_order,
             #     # "physical_pixel_sizes": physical_pixel_sizes,
@@ -116,6 +127,44 @@ def export_tiff(
     return ret
 
 
+def content_key(*arrays: np.ndarray, salt: str = "") -> str:
+    """
+    content hash of one or more arrays, for keying cached inferred organelles on their inputs rather
+    than on the file name alone.  shape and dtype are hashed along with the raw buffer so e.g. a
+    reshaped or re-typed array gets a different key.
+
+    Parameters
+    ------------
+    *arrays:
+        np.ndarray inputs to hash
+    salt:
+        extra string mixed into the hash (i.e. organelle name + channel)
+
+    Returns
+    -------------
+    32 character hex digest
+
+    """
+    h = hashlib.blake2b(salt.encode(), digest_size=16)
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(f"{arr.shape}{arr.dtype.str}".encode())
+        h.update(memoryview(arr).cast("B"))
+    return h.hexdigest()
+
+
+def read_tiff_content_key(image_name) -> Union[str, None]:
+    """
+    return the content key stored by `export_tiff` in the tiff's metadata, or None if it has none.
+    only the header is read, not the image data
+    """
+    with TiffFile(image_name) as tif:
+        shaped_metadata = tif.shaped_metadata
+    if not shaped_metadata:
+        return None
+    return shaped_metadata[0].get("content_key")
+
+
 # function to collect all the
 def list_image_files(data_folder: Path, file_type: str, postfix: Union[str, None] = None) -> List:
     """
@@ -170,7 +219,9 @@ class AICSImageReaderWrap:
         self.raw_meta = get_raw_meta_data(meta)
 
 
-def import_inferred_organelle(name: str, meta_dict: Dict, out_data_path: Path, file_type: str) -> Union[np.ndarray, None]:
+def import_inferred_organelle(
+    name: str, meta_dict: Dict, out_data_path: Path, file_type: str, key: Union[str, None] = None
+) -> Union[np.ndarray, None]:
     """
     read inferred organelle from ome.tif file
 
@@ -184,6 +235,9 @@ def import_inferred_organelle(name: str, meta_dict: Dict, out_data_path: Path, f
         Path object of directory where tiffs are read from
     file_type: 
         The type of file you want to import as a string (ex - ".tif", ".tiff", ".czi", etc.)
+    key:
+        optional content key of the inputs (see `content_key`).  if given, a file without the same key in its
+        metadata is stale and raises ValueError instead of being loaded
 
     Returns
     -------------
@@ -201,6 +255,9 @@ def import_inferred_organelle(name: str, meta_dict: Dict, out_data_path: Path, f
         organelle_path = out_data_path / organelle_fname
 
         if Path.exists(organelle_path):
+            if key is not None and read_tiff_content_key(organelle_path) != key:
+                print(f"`{name}` object is stale: {organelle_path}")
+                raise ValueError(f"`{name}` object was inferred from different inputs: {organelle_path}")
             # organelle_obj, _meta_dict = read_ome_image(organelle_path)
             organelle_obj = read_tiff_image(organelle_path)  # .squeeze()
             print(f"loaded  inferred {len(organelle_obj.shape)}D `{name}`  from {out_data_path} ")
@@ -248,7 +305,9 @@ def import_inferred_organelle(name: str, meta_dict: Dict, out_data_path: Path, f
 #         raise FileNotFoundError(f"`{name}` object not found: {organelle_path}")
 
 
-def export_inferred_organelle(img_out: np.ndarray, name: str, meta_dict: Dict, out_data_path: Path) -> str:
+def export_inferred_organelle(
+    img_out: np.ndarray, name: str, meta_dict: Dict, out_data_path: Path, key: Union[str, None] = None
+) -> str:
     """
     write inferred organelle to ome.tif file
 
@@ -262,6 +321,8 @@ def export_inferred_organelle(img_out: np.ndarray, name: str, meta_dict: Dict, o
         dictionary of meta-data (ome) only using original file name here, but could add metadata
     out_data_path:
         Path object where tiffs are written to
+    key:
+        optional content key of the inputs (see `content_key`), stored in the tiff's metadata
 
     Returns
     -------------
@@ -285,7 +346,7 @@ def export_inferred_organelle(img_out: np.ndarray, name: str, meta_dict: Dict, o
     img_name_out = f"{img_name.stem}-{name}"
     # HACK: skip the ome
     # out_file_n = export_ome_tiff(img_out, meta_dict, img_name_out, str(out_data_path) + "/", name)
-    out_file_n = export_tiff(img_out, img_name_out, out_data_path, name, meta_dict)
+    out_file_n = export_tiff(img_out, img_name_out, out_data_path, name, meta_dict, key=key)
     print(f"saved file: {img_name_out}")
     return out_file_n
 
@@ -1,23 +1,33 @@
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 from skimage.filters import threshold_triangle, threshold_otsu, threshold_li, threshold_multiotsu, threshold_sauvola
 
 # from skimage.filters import threshold_triangle, threshold_otsu, threshold_li, threshold_multiotsu, threshold_sauvola
 from scipy.ndimage import median_filter, extrema, distance_transform_edt, sum, minimum_filter, maximum_filter
+from scipy.ndimage import label as ndi_label, generate_binary_structure, find_objects, binary_erosion
+from scipy import ndimage
 
-from aicssegmentation.core.utils import size_filter, hole_filling
+try:
+    import cupy
+    from cupyx.scipy import ndimage as cupy_ndimage
+except ImportError:  # cupy is optional.  only needed for the "cupy" (GPU) backend
+    cupy = None
+
+try:
+    import cv2
+except ImportError:  # opencv is optional.  only used to speed up binary erosion
+    cv2 = None
+
+from aicssegmentation.core.utils import hole_filling
 from aicssegmentation.core.vessel import vesselness2D
-from aicssegmentation.core.MO_threshold import MO
 
 from aicssegmentation.core.vessel import filament_2d_wrapper, filament_3d_wrapper
-from aicssegmentation.core.pre_processing_utils import (
-    image_smoothing_gaussian_slice_by_slice,
-    # edge_preserving_smoothing_3d,
-)
-from aicssegmentation.core.seg_dot import dot_2d_slice_by_slice_wrapper, dot_3d_wrapper
+# from aicssegmentation.core.pre_processing_utils import edge_preserving_smoothing_3d
 
 from typing import Tuple, List, Union, Any
 
-from skimage.morphology import remove_small_objects, white_tophat, ball, disk, black_tophat, label
+from skimage.morphology import remove_small_objects, white_tophat, ball, disk, black_tophat, label, medial_axis
 from skimage.segmentation import clear_border, watershed
 
 from infer_subc.constants import (
@@ -45,6 +55,36 @@ def stack_masks(nuc_mask: np.ndarray, cellmask: np.ndarray, cyto_mask: np.ndarra
     return np.stack(layers, axis=0).astype(np.uint8)
 
 
+def to_backend(img_in: np.ndarray, backend: str = "numpy") -> np.ndarray:
+    """
+    move an image to the array backend: "numpy" (host) or "cupy" (GPU, requires cupy)
+    """
+    if backend == "numpy":
+        return to_numpy(img_in)
+    elif backend == "cupy":
+        if cupy is None:
+            raise ImportError("backend 'cupy' requires cupy to be installed")
+        return cupy.asarray(img_in)
+    else:
+        raise NotImplementedError(f"unsupported backend {backend}")
+
+
+def to_numpy(img_in: np.ndarray) -> np.ndarray:
+    """
+    bring an image back to the host as np.ndarray (no-op for numpy arrays)
+    """
+    if cupy is not None and isinstance(img_in, cupy.ndarray):
+        return cupy.asnumpy(img_in)
+    return img_in
+
+
+def _ndimage_for(img_in: np.ndarray):
+    """the `scipy.ndimage` API matching the image's array backend (`cupyx.scipy.ndimage` for cupy arrays)"""
+    if cupy is not None and isinstance(img_in, cupy.ndarray):
+        return cupy_ndimage
+    return ndimage
+
+
 # TODO: check that the "noise" for the floor is correct... inverse_log should remove it?
 def log_transform(image: np.ndarray) -> Tuple[np.ndarray, dict]:
     """Renormalize image intensities to log space
@@ -218,7 +258,9 @@ def masked_object_thresh(
     structure_img_smooth: np.ndarray, global_method: str, cutoff_size: int, local_adjust: float
 ) -> np.ndarray:
     """
-    wrapper for applying Masked Object Thresholding with just two parameters via `MO` from `aicssegmentation`
+    Masked Object Thresholding with just two parameters.  Same result as `MO` from `aicssegmentation`
+    (extra_criteria=True, dilate=False) but each object's local otsu threshold is computed and applied within its
+    bounding box, rather than with a full-volume `labels == idx` pass per object
 
     Parameters
     ------------
@@ -238,15 +280,32 @@ def masked_object_thresh(
         np.ndimage
 
     """
-    struct_obj = MO(
-        structure_img_smooth,
-        object_minArea=cutoff_size,
-        global_thresh_method=global_method,
-        extra_criteria=True,
-        local_adjust=local_adjust,
-        return_object=False,
-        dilate=False,  # WARNING: dilate=True causes a bug if there is only one Z
-    )
+    # low level: global threshold and small object removal
+    if global_method == "tri" or global_method == "triangle":
+        th_low_level = threshold_triangle(structure_img_smooth)
+    elif global_method == "med" or global_method == "median":
+        th_low_level = np.percentile(structure_img_smooth, 50)
+    elif global_method == "ave" or global_method == "ave_tri_med":
+        global_tri = threshold_triangle(structure_img_smooth)
+        global_median = np.percentile(structure_img_smooth, 50)
+        th_low_level = (global_tri + global_median) / 2
+    else:
+        raise NotImplementedError(f"unsupported global_method {global_method}")
+
+    bw_low_level = remove_small_objects(structure_img_smooth > th_low_level, min_size=cutoff_size, connectivity=1)
+
+    # high level: local otsu threshold within each object
+    local_cutoff = 0.333 * threshold_otsu(structure_img_smooth)
+    lab_low, _ = ndi_label(bw_low_level, structure=generate_binary_structure(bw_low_level.ndim, 1))
+
+    struct_obj = np.zeros_like(bw_low_level)
+    for idx, obj_slice in enumerate(find_objects(lab_low), start=1):
+        single_obj = lab_low[obj_slice] == idx
+        obj_img = structure_img_smooth[obj_slice]
+        local_otsu = threshold_otsu(obj_img[single_obj])
+        if local_otsu > local_cutoff:
+            struct_obj[obj_slice] |= single_obj & (obj_img > local_otsu * local_adjust)
+
     return struct_obj
 
 
@@ -276,7 +335,7 @@ def get_interior_labels(img_in: np.ndarray) -> np.ndarray:
     # return label(interior).astype(np.uint16)
 
 
-def label_uint16(in_obj: np.ndarray) -> np.ndarray:
+def label_uint16(in_obj: np.ndarray, out: Union[np.ndarray, None] = None) -> np.ndarray:
     """
     label segmentation and return as uint16
 
@@ -284,16 +343,26 @@ def label_uint16(in_obj: np.ndarray) -> np.ndarray:
     ------------
     in_obj:
         a 3d image segmentaiton
+    out:
+        optional preallocated np.uint16 array to write the labels into (e.g. reused across a batch)
 
     Returns
     -------------
-        np.ndimage of labeled segmentations as np.uint16
+        np.ndimage of labeled segmentations as np.uint16.  raises ValueError if there are more than 65535 objects
+        (they do not fit in np.uint16)
 
     """
-    if in_obj.dtype == "bool":
-        return label(in_obj).astype(np.uint16)
-    else:  # in_obj.dtype == np.uint8:
-        return label(in_obj > 0).astype(np.uint16)
+    if out is None:
+        out = np.empty(in_obj.shape, dtype=np.uint16)
+    # full connectivity like skimage `label`, but written straight to uint16 (no int64 labels + astype)
+    structure = generate_binary_structure(in_obj.ndim, in_obj.ndim)
+    try:
+        ndi_label(in_obj, structure=structure, output=out)
+    except RuntimeError:
+        # scipy refuses to write more labels than the output dtype can hold
+        _, n_labels = ndi_label(in_obj, structure=structure)
+        raise ValueError(f"{n_labels} objects found, more than the {np.iinfo(np.uint16).max} np.uint16 labels can hold")
+    return out
 
 
 def label_bool_as_uint16(in_obj: np.ndarray) -> np.ndarray:
@@ -339,20 +408,25 @@ def median_filter_slice_by_slice(struct_img: np.ndarray, size: int) -> np.ndarra
     return structure_img_denoise
 
 
-def min_max_intensity_normalization(struct_img: np.ndarray) -> np.ndarray:
+def min_max_intensity_normalization(struct_img: np.ndarray, min_max: Union[Tuple, None] = None) -> np.ndarray:
     """Normalize the intensity of input image so that the value range is from 0 to 1.
 
     Parameters
     ------------
     img:
         a 3d image
+    min_max:
+        optional (min, max) to scale with instead of the image's own, e.g. when `img` is a Z tile of a larger volume
 
     Returns
     -------------
         np.ndimage
     """
-    strech_min = struct_img.min()
-    strech_max = struct_img.max()
+    if min_max is None:
+        strech_min = struct_img.min()
+        strech_max = struct_img.max()
+    else:
+        strech_min, strech_max = min_max
     # do we need to convert to float?
     # #.astype(np.double)
     struct_img = (struct_img - strech_min + 1e-8) / (strech_max - strech_min + 1e-8)
@@ -569,7 +643,9 @@ def vesselness_slice_by_slice(nd_array: np.ndarray, sigma: float, cutoff: float
 
 def select_channel_from_raw(img_in: np.ndarray, chan: Union[int, Tuple[int]]) -> np.ndarray:
     """ "
-    select channel from multi-channel 3D image (np.ndarray)
+    select channel from multi-channel 3D image (np.ndarray).  The channel is returned C-contiguous so the downstream
+    filters run with unit stride along X.  This is a no-op view for the usual C-ordered CZYX array, and a single copy
+    when the raw image is in another memory layout (e.g. channel-last, or a transposed reader view)
     Parameters
     ------------
     img_in :
@@ -581,7 +657,7 @@ def select_channel_from_raw(img_in: np.ndarray, chan: Union[int, Tuple[int]]) ->
     -------------
         np.ndarray
     """
-    return img_in[chan]
+    return np.ascontiguousarray(img_in[chan])
 
 
 def select_z_from_raw(img_in: np.ndarray, z_slice: Union[int, Tuple[int]]) -> np.ndarray:
@@ -608,34 +684,53 @@ def select_z_from_raw(img_in: np.ndarray, z_slice: Union[int, Tuple[int]]) -> np
 
 
 def scale_and_smooth(
-    img_in: np.ndarray, median_size: int = 1, gauss_sigma: float = 1.34, slice_by_slice: bool = True
+    img_in: np.ndarray,
+    median_size: int = 1,
+    gauss_sigma: float = 1.34,
+    slice_by_slice: bool = True,
+    out: Union[np.ndarray, None] = None,
+    min_max: Union[Tuple, None] = None,
 ) -> np.ndarray:
     """
-    helper to perform min-max scaling, and median+gaussian smoothign all at once
+    helper to perform min-max scaling, and median+gaussian smoothign all at once.
+    The slice-by-slice median and gaussian are each run as a single 3D filter with a flat footprint / zero sigma
+    along Z, writing into one preallocated buffer (same result as the 2D filters applied slice by slice)
+
     Parameters
     ------------
     img_in: np.ndarray
-        a 3d image
+        a 3d image (np.ndarray, or cupy.ndarray to run on the GPU)
     median_size: int
         width of median filter for signal
     gauss_sigma: float
         sigma for gaussian smoothing of  signal
     slice_by_slice:
         NOT IMPLIMENTED.  toggles whether to do 3D operations or slice by slice in Z
+    out:
+        optional preallocated float array (same shape) to write the result into
+    min_max:
+        optional (min, max) for the scaling, see `min_max_intensity_normalization`
 
     Returns
     -------------
         np.ndimage
 
     """
-    img = min_max_intensity_normalization(img_in.copy())  # is this copy nescesa
+    img = min_max_intensity_normalization(img_in, min_max)  # returns a new array, no need to copy
 
     # TODO:  make non-slice-by-slice work
     slice_by_slice = True
     if slice_by_slice:
+        ndi = _ndimage_for(img)
+        if out is None:
+            out = np.empty_like(img)
         if median_size > 1:
-            img = median_filter_slice_by_slice(img, size=median_size)
-        img = image_smoothing_gaussian_slice_by_slice(img, sigma=gauss_sigma)
+            ndi.median_filter(img, size=(1, median_size, median_size), output=out)
+            img = out
+        # same as aicssegmentation `image_smoothing_gaussian_slice_by_slice`.  the separable gaussian runs one axis
+        #   at a time, so it can work in place on the median output
+        ndi.gaussian_filter(img, sigma=(0, gauss_sigma, gauss_sigma), mode="nearest", truncate=3.0, output=out)
+        img = out
     else:
         print(" PLEASE CHOOOSE 'slice-by-slice', 3D is not yet implimented")
 
@@ -795,6 +890,41 @@ def get_max_label(
     return keep_label
 
 
+def size_filter(img: np.ndarray, min_size: int, method: str = "3D", connectivity: int = 1) -> np.ndarray:
+    """size filter.  Same result as aicssegmentation `size_filter`: one connected component labeling followed by a
+    `np.bincount` of the object sizes and a lookup-table gather.  "slice_by_slice" labels every slice in a single call
+    with a structuring element that does not connect along Z, instead of looping over Z
+
+    Parameters
+    ------------
+    img:
+        the 3D image to filter on
+    min_size: int
+        the minimum size (in voxels) to keep
+    method: str
+        either "3D" or "slice_by_slice", default is "3D"
+    connnectivity: int
+        the connectivity to use when computing object size
+
+    Returns
+    -------------
+        boolean np.ndarray
+    """
+    assert len(img.shape) == 3, "image has to be 3D"
+    if method == "3D":
+        structure = generate_binary_structure(3, connectivity)
+    elif method == "slice_by_slice":
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[1] = generate_binary_structure(2, connectivity)
+    else:
+        raise NotImplementedError(f"unsupported method {method}")
+
+    labels, _ = ndi_label(img > 0, structure=structure)
+    keep = np.bincount(labels.ravel()) >= min_size
+    keep[0] = False  # background
+    return keep[labels]
+
+
 def fill_and_filter_linear_size(
     img: np.ndarray, hole_min: int, hole_max: int, min_size: int, method: str = "slice_by_slice", connectivity: int = 1
 ) -> np.ndarray:
@@ -836,7 +966,7 @@ def fill_and_filter_linear_size(
 def size_filter_linear_size(
     img: np.ndarray, min_size: int, method: str = "slice_by_slice", connectivity: int = 1
 ) -> np.ndarray:
-    """size filter wraper to aiscsegmentation `size_filter` with size argument in linear units
+    """size filter wraper to `size_filter` with size argument in linear units
 
     Parameters
     ------------
@@ -864,6 +994,96 @@ def size_filter_linear_size(
         raise NotImplementedError(f"unsupported method {method}")
 
 
+def opencv_available() -> bool:
+    """whether opencv is installed, i.e. `binary_erosion_planes` runs its 2D erosions in `cv2.erode`"""
+    return cv2 is not None
+
+
+def binary_erosion_planes(bw: np.ndarray, footprint: np.ndarray) -> np.ndarray:
+    """3D binary erosion as the AND of 2D erosions: each Z plane of the footprint erodes the correspondingly shifted
+    image slice.  The 2D erosions run in opencv (`cv2.erode`, multi-threaded and SIMD) when it is installed, otherwise
+    this is just `scipy.ndimage.binary_erosion`.  Voxels beyond the border count as foreground in both cases
+
+    Parameters
+    ------------
+    bw: np.ndarray
+        the 3D binary image to erode
+    footprint: np.ndarray
+        the 3D structuring element, i.e. `ball(r)`
+
+    Returns
+    -----------
+        eroded boolean np.ndarray
+    """
+    if cv2 is None or bw.ndim != 3 or footprint.ndim != 3:
+        return binary_erosion(bw, structure=footprint, border_value=1)
+
+    src = np.ascontiguousarray(bw, dtype=bool).view(np.uint8)
+    eroded = np.ones_like(src)
+    plane = np.empty_like(src[0])
+    nz = src.shape[0]
+    for dz in range(footprint.shape[0]):
+        kernel = footprint[dz].astype(np.uint8)
+        if not kernel.any():
+            continue
+        offset = dz - footprint.shape[0] // 2
+        for z in range(max(0, -offset), min(nz, nz - offset)):
+            cv2.erode(src[z + offset], kernel, dst=plane, borderType=cv2.BORDER_CONSTANT, borderValue=1)
+            eroded[z] &= plane
+
+    return eroded.view(bool)
+
+
+def topology_preserving_thinning(bw: np.ndarray, min_thickness: int = 1, thin: int = 1) -> np.ndarray:
+    """perform thinning on segmentation without breaking topology.  Same algorithm (and result) as aicssegmentation
+    `topology_preserving_thinning`, but only the bounding box of the foreground is processed, empty slices are skipped
+    and the boundary is found with a binary (rather than grey-level) erosion
+
+    Parameters
+    ------------
+    bw: np.ndarray
+        the 3D binary image to be thinned
+    min_thickness: int
+        Half of the minimum width you want to keep from being thinned.
+        For example, when the object width is smaller than 4, you don't
+        want to make this part even thinner (may break the thin object
+        and alter the topology), you can set this value as 2.
+    thin: int
+        the amount to thin (has to be an positive integer). The number of
+         pixels to be removed from outter boundary towards center.
+
+    Returns
+    -----------
+        A binary image after thinning
+    """
+    bw = bw > 0
+    obj_slice = find_objects(bw.view(np.uint8))
+    if not obj_slice:
+        return bw
+
+    # pad the bounding box so the erosion and the medial axis see the real background around the objects
+    selem = ball(thin)
+    crop = tuple(
+        slice(max(sl.start - max(sz // 2, 1), 0), min(sl.stop + max(sz // 2, 1), dim))
+        for sl, sz, dim in zip(obj_slice[0], selem.shape, bw.shape)
+    )
+    bw_crop = bw[crop]
+
+    safe_zone = np.zeros_like(bw_crop)
+    for zz in range(bw_crop.shape[0]):
+        if np.any(bw_crop[zz, :, :]):
+            ctl = medial_axis(bw_crop[zz, :, :])
+            dist = distance_transform_edt(ctl == 0)
+            safe_zone[zz, :, :] = dist > min_thickness + 1e-5
+
+    # voxels beyond the volume border count as foreground (same as the grey erosion's "reflect" mode)
+    eroded = binary_erosion_planes(bw_crop, selem)
+
+    # remove the outer boundary (bw AND NOT eroded) where it is far enough from the medial axis
+    bw_crop &= ~safe_zone | eroded
+    return bw
+
+
 def hole_filling_linear_size(img: np.ndarray, hole_min: int, hole_max: int, fill_2d=True) -> np.ndarray:
     """Fill holes  wraper to aiscsegmentation `hole_filling` with size argument in linear units.  always does slice-by-slice
 
@@ -1089,6 +1309,95 @@ def filament_filter(in_img: np.ndarray, filament_scale: float, filament_cut: flo
 #     return dot_2d_slice_by_slice_wrapper(in_img, s2_param)
 
 
+def _dot_2d_slice_by_slice_chunk(in_img: np.ndarray, s_param: List, bw: np.ndarray):
+    """`dot_2d_slice_by_slice` on a block of Z slices, OR-ing the dots into `bw`"""
+    ndi = _ndimage_for(in_img)
+    # float32 responses halve the memory traffic.  this is not only a rounding of the final result: `gaussian_filter`
+    #   is separable and stores each 1D pass in `response` / `d2_x`, so the intermediate (Y then X) passes are rounded
+    #   to float32 too.  the dots differ from float64 buffers by a handful of voxels sitting at the cutoff
+    response = np.empty_like(in_img, dtype=np.float32)
+    d2_x = np.empty_like(in_img, dtype=np.float32)
+    for log_sigma, cutoff in s_param:
+        sigma = (0, log_sigma, log_sigma)
+        ndi.gaussian_filter(in_img, sigma, order=(0, 2, 0), output=response)
+        ndi.gaussian_filter(in_img, sigma, order=(0, 0, 2), output=d2_x)
+        response += d2_x
+        np.multiply(response, -1 * (log_sigma**2), out=response)
+        bw |= response > cutoff
+
+
+def dot_2d_slice_by_slice(in_img: np.ndarray, s_param: List, workers: Union[int, None] = None) -> np.ndarray:
+    """2D spot filter on a 3D image slice by slice.  same algorithm as aicssegmentation `dot_2d_slice_by_slice_wrapper`,
+    but the 2D laplacian of gaussian is applied to the whole volume as two gaussian second derivatives (Y and X) with
+    zero sigma along Z, so each scale is one sweep of the volume instead of a python loop over Z.
+    NOTE: `scipy.ndimage.gaussian_laplace` with sigma=(0, s, s) is NOT equivalent; it adds the smoothed image for the
+    Z axis
+
+    Z slices are independent, so numpy volumes are split into blocks of slices which are filtered on a thread pool
+    (scipy.ndimage releases the GIL)
+
+    Parameters
+    ------------
+    in_img:
+        a 3d  np.ndarray (or cupy.ndarray) image, usually after smoothing
+    s_param:
+        [[scale_1, cutoff_1], [scale_2, cutoff_2], ....]
+    workers:
+        number of threads for numpy volumes. None (default) uses `os.cpu_count()`, 1 runs in the calling thread
+
+    Returns
+    -------------
+    segmented dots as boolean np.ndarray
+
+    """
+    bw = np.zeros_like(in_img, dtype=bool)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, in_img.shape[0])
+
+    if workers <= 1 or _ndimage_for(in_img) is not ndimage:
+        _dot_2d_slice_by_slice_chunk(in_img, s_param, bw)
+    else:
+        bounds = np.linspace(0, in_img.shape[0], workers + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_dot_2d_slice_by_slice_chunk, in_img[z0:z1], s_param, bw[z0:z1])
+                for z0, z1 in zip(bounds[:-1], bounds[1:])
+            ]
+            for future in futures:
+                future.result()
+
+    return bw
+
+
+def dot_3d(in_img: np.ndarray, s_param: List) -> np.ndarray:
+    """3D spot filter.  same algorithm as aicssegmentation `dot_3d_wrapper`, but runs on either array backend and
+    reuses a single float32 response buffer across scales.  the separable gaussian passes are stored in float32, so a
+    handful of voxels sitting at the cutoff can differ from aicssegmentation
+
+    Parameters
+    ------------
+    in_img:
+        a 3d  np.ndarray (or cupy.ndarray) image, usually after smoothing
+    s_param:
+        [[scale_1, cutoff_1], [scale_2, cutoff_2], ....]
+
+    Returns
+    -------------
+    segmented dots as boolean np.ndarray
+
+    """
+    ndi = _ndimage_for(in_img)
+    bw = np.zeros_like(in_img, dtype=bool)
+    response = np.empty_like(in_img, dtype=np.float32)
+    for log_sigma, cutoff in s_param:
+        ndi.gaussian_laplace(in_img, log_sigma, output=response)
+        np.multiply(response, -1 * (log_sigma**2), out=response)
+        bw |= response > cutoff
+
+    return bw
+
+
 def dot_filter_3(
     in_img: np.ndarray,
     dot_scale_1: float,
@@ -1097,10 +1406,15 @@ def dot_filter_3(
     dot_cutoff_2: float,
     dot_scale_3: float,
     dot_cutoff_3: float,
-    method: str = "slice_by_slice"
+    method: str = "slice_by_slice",
+    workers: Union[int, None] = None,
 ) -> np.ndarray:
     """spot filter helper function for 3 levels (scale+cut). filter pairs are run if scale is > 0.
 
+    the filter responses are computed in float32 (see `dot_2d_slice_by_slice` and `dot_3d`), so voxels sitting at a
+    cutoff can flip relative to aicssegmentation.  this is shared by the golgi, lysosome, peroxisome and mitochondria
+    segmentations, so all of their masks can change by these few voxels
+
     Parameters
     ------------
     in_img:
@@ -1119,6 +1433,8 @@ def dot_filter_3(
         cutoff for thresholding float
     method:
         either "3D" or "slice_by_slice", default is "slice_by_slice"
+    workers:
+        number of threads for the "slice_by_slice" filter, see `dot_2d_slice_by_slice`
 
     Returns
     -------------
@@ -1130,9 +1446,9 @@ def dot_filter_3(
     s_param = [[sc, ct] for sc, ct in zip(scales, cuts) if sc > 0]
 
     if method == "3D":
-        seg = dot_3d_wrapper(in_img, s_param)
+        seg = dot_3d(in_img, s_param)
     elif method == "slice_by_slice":
-        seg = dot_2d_slice_by_slice_wrapper(in_img, s_param)
+        seg = dot_2d_slice_by_slice(in_img, s_param, workers)
     else:
         print(f"undefined method: {method}")
 
@@ -1,12 +1,19 @@
 import numpy as np
-from typing import Dict
+from typing import Dict, Union
 from pathlib import Path
 import time
 
-from skimage.morphology import binary_erosion
-from infer_subc.core.file_io import export_inferred_organelle, import_inferred_organelle
-from infer_subc.core.img import (apply_mask, 
-                                 label_bool_as_uint16, 
+from scipy.signal import fftconvolve
+
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional.  fall back to the numpy erosion
+    njit = None
+
+from infer_subc.core.file_io import export_inferred_organelle, import_inferred_organelle, content_key
+from infer_subc.core.img import (label_bool_as_uint16, 
+                                 binary_erosion_planes,
+                                 opencv_available,
                                  weighted_aggregate, 
                                  scale_and_smooth, 
                                  masked_object_thresh, 
@@ -15,10 +22,154 @@ from infer_subc.core.img import (apply_mask,
 from infer_subc.organelles.cellmask import non_linear_cellmask_transform
 
 
+def _pack_bool_x(img_in: np.ndarray) -> np.ndarray:
+    """
+    pack a boolean volume into np.uint64 bitfields along the last (x) axis, 64 voxels per word with voxel
+    x in bit x % 64.  x is padded up to a multiple of 64 with foreground, so padding never erodes a real voxel
+
+    Parameters
+    ------------
+    img_in:
+        a 3d image (boolean or labels)
+
+    Returns
+    -------------
+        np.uint64 array of shape (..., ceil(nx / 64))
+    """
+    bw = img_in.astype(bool, copy=False)
+    pad = -bw.shape[-1] % 64
+    if pad:
+        bw = np.concatenate([bw, np.ones(bw.shape[:-1] + (pad,), dtype=bool)], axis=-1)
+    return np.packbits(bw, axis=-1, bitorder="little").view("<u8")
+
+
+def _unpack_bool_x(packed: np.ndarray, nx: int) -> np.ndarray:
+    """
+    inverse of `_pack_bool_x`.  returns the first `nx` voxels along x as a boolean np.ndarray
+    """
+    return np.unpackbits(packed.view(np.uint8), axis=-1, count=nx, bitorder="little").view(bool)
+
+
+def _binary_erosion_cross_packed(packed: np.ndarray) -> np.ndarray:
+    """
+    binary erosion with the default connectivity-1 ("cross") footprint on a `_pack_bool_x` volume.  The cross
+    is the union of a 3-voxel line along each axis, so the erosion is the AND of the shifted volume along every
+    axis, 64 voxels per operation.  Along x the neighbors are bit shifts with the end bit carried in from the
+    adjacent word; along y/z they are whole-word slices.
+    Voxels beyond the border count as foreground (matches `skimage.morphology.binary_erosion`)
+
+    Parameters
+    ------------
+    packed:
+        np.uint64 packed volume from `_pack_bool_x`
+
+    Returns
+    -------------
+        eroded np.uint64 packed volume
+    """
+    one, top = np.uint64(1), np.uint64(63)
+    eroded = packed.copy()
+
+    # x - 1: shift up a bit, carrying in bit 63 of the previous word (foreground at the border)
+    carry = np.empty_like(packed)
+    carry[..., 0] = 1
+    np.right_shift(packed[..., :-1], top, out=carry[..., 1:])
+    eroded &= (packed << one) | carry
+    # x + 1: shift down a bit, carrying in bit 0 of the next word
+    carry[..., -1] = 1
+    np.bitwise_and(packed[..., 1:], one, out=carry[..., :-1])
+    eroded &= (packed >> one) | (carry << top)
+
+    for axis in range(packed.ndim - 1):
+        lo = [slice(None)] * packed.ndim
+        hi = [slice(None)] * packed.ndim
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        eroded[tuple(lo)] &= packed[tuple(hi)]
+        eroded[tuple(hi)] &= packed[tuple(lo)]
+
+    return eroded
+
+
+def _binary_erosion_fft(img_in: np.ndarray, footprint: np.ndarray) -> np.ndarray:
+    """
+    binary erosion via FFT correlation: a voxel survives when the footprint-weighted count of its
+    neighbors equals the footprint size.  Cost is O(N log N) regardless of footprint size, so this beats the
+    spatial erosion for medium/large footprints. Voxels beyond the border count as foreground
+    (matches `scipy.ndimage.binary_erosion(..., border_value=1)`)
+
+    Parameters
+    ------------
+    img_in:
+        a 3d image (boolean or labels)
+    footprint:
+        the structuring element
+
+    Returns
+    -------------
+        eroded boolean np.ndarray
+    """
+    footprint = footprint.astype(bool)
+    pad = [(sz // 2, sz - 1 - sz // 2) for sz in footprint.shape]
+    padded = np.pad(img_in.astype(np.float32), pad, mode="constant", constant_values=1)
+
+    # correlation == convolution with the flipped footprint
+    kernel = footprint[tuple(slice(None, None, -1) for _ in footprint.shape)].astype(np.float32)
+    counts = fftconvolve(padded, kernel, mode="valid")
+
+    # counts are integers up to float32 round-off
+    return counts > (footprint.sum() - 0.5)
+
+
+if njit is not None:
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _erode_cross_and_not(cellmask: np.ndarray, nucleus: np.ndarray, out: np.ndarray):
+        """
+        fused connectivity-1 erosion of the nucleus masked by the cellmask + cellmask AND NOT nucleus.  reads both
+        (boolean) volumes once and writes `out` without materializing the masked or eroded nucleus.  borders behave
+        like `_binary_erosion_cross_packed`
+        """
+        nz, ny, nx = nucleus.shape
+        for z in prange(nz):
+            for y in range(ny):
+                for x in range(nx):
+                    nuc = (
+                        (nucleus[z, y, x] and cellmask[z, y, x])
+                        and (z == 0 or (nucleus[z - 1, y, x] and cellmask[z - 1, y, x]))
+                        and (z == nz - 1 or (nucleus[z + 1, y, x] and cellmask[z + 1, y, x]))
+                        and (y == 0 or (nucleus[z, y - 1, x] and cellmask[z, y - 1, x]))
+                        and (y == ny - 1 or (nucleus[z, y + 1, x] and cellmask[z, y + 1, x]))
+                        and (x == 0 or (nucleus[z, y, x - 1] and cellmask[z, y, x - 1]))
+                        and (x == nx - 1 or (nucleus[z, y, x + 1] and cellmask[z, y, x + 1]))
+                    )
+                    out[z, y, x] = cellmask[z, y, x] and not nuc
+
+
+def _boundary_ratio(bw: np.ndarray) -> float:
+    """
+    cheap estimate of how much a 1 voxel erosion would remove: foreground/background transitions between neighbors
+    along every axis (one vectorized compare per axis, so the XY rim counts as well as the Z faces) per foreground
+    voxel.  0 for an empty mask
+    """
+    n_fg = np.count_nonzero(bw)
+    if n_fg == 0:
+        return 0.0
+    return sum(np.count_nonzero(np.diff(bw, axis=axis)) for axis in range(bw.ndim)) / n_fg
+
+
 ##########################
 #  infer_cytoplasm
 ##########################
-def infer_cytoplasm(nuclei_object: np.ndarray, cellmask: np.ndarray, erode_nuclei: bool = True) -> np.ndarray:
+def infer_cytoplasm(
+    nuclei_object: np.ndarray,
+    cellmask: np.ndarray,
+    erode_nuclei: bool = True,
+    footprint: Union[np.ndarray, None] = None,
+    out: Union[np.ndarray, None] = None,
+    erode_policy: Union[str, None] = None,
+    erode_boundary_ratio: float = 0.02,
+) -> np.ndarray:
     """
     Procedure to infer infer from linearly unmixed input. (logical cellmask AND NOT nucleus)
 
@@ -30,6 +181,19 @@ def infer_cytoplasm(nuclei_object: np.ndarray, cellmask: np.ndarray, erode_nucle
         a 3d image containing the cellmask object (mask)
     erode_nuclei:
         should we erode?
+    footprint:
+        structuring element for the nuclei erosion. None (default) is the connectivity-1 "cross".
+        explicit footprints are eroded plane by plane with opencv when installed, otherwise large footprints
+        (more than 3x3x3 elements) are eroded via FFT
+    out:
+        optional preallocated np.uint16 array to write the mask into (e.g. reused across a batch)
+    erode_policy:
+        None (default) follows `erode_nuclei`.  "always" / "never" override it.  "auto" skips the erosion when the
+        nuclei are large relative to their surface, i.e. the boundary transitions along Z, Y and X per nucleus voxel
+        are below `erode_boundary_ratio` (the erosion would then change few voxels).  "auto" is a heuristic: when
+        it skips, the result differs from eroding by roughly that fraction of the nucleus voxels
+    erode_boundary_ratio:
+        threshold for `erode_policy="auto"`
 
     Returns
     -------------
@@ -37,18 +201,48 @@ def infer_cytoplasm(nuclei_object: np.ndarray, cellmask: np.ndarray, erode_nucle
         boolean np.ndarray
 
     """
-    nucleus_obj = apply_mask(nuclei_object, cellmask)
-
-    if erode_nuclei:
-        cytoplasm_mask = np.logical_xor(cellmask, binary_erosion(nucleus_obj))
+    cytoplasm_mask = np.empty(cellmask.shape, dtype=np.uint16) if out is None else out
+    cellmask = cellmask.astype(bool, copy=False)
+    nuclei_object = nuclei_object.astype(bool, copy=False)
+
+    if erode_policy == "auto":
+        erode_nuclei = _boundary_ratio(nuclei_object) >= erode_boundary_ratio
+    elif erode_policy in ("always", "never"):
+        erode_nuclei = erode_policy == "always"
+    elif erode_policy is not None:
+        raise ValueError(f"undefined erode_policy: {erode_policy}")
+
+    # the nucleus is restricted to the cellmask only where it matters, i.e. before the erosion.
+    #   cellmask AND NOT (nucleus AND cellmask) == cellmask AND NOT nucleus, so without erosion no masked copy is made
+    if not erode_nuclei:
+        np.greater(cellmask, nuclei_object, out=cytoplasm_mask)
+    elif footprint is None and njit is not None and nuclei_object.ndim == 3:
+        # masking, erosion and AND NOT fused into a single pass
+        _erode_cross_and_not(cellmask, nuclei_object, cytoplasm_mask)
+    elif footprint is None:
+        # bit-packed masking, erosion and AND NOT, 64 voxels per word
+        cellmask_packed = _pack_bool_x(cellmask)
+        nucleus_packed = _pack_bool_x(nuclei_object)
+        nucleus_packed &= cellmask_packed
+        nucleus_packed = _binary_erosion_cross_packed(nucleus_packed)
+        np.bitwise_and(cellmask_packed, ~nucleus_packed, out=nucleus_packed)
+        cytoplasm_mask[...] = _unpack_bool_x(nucleus_packed, cellmask.shape[-1])
     else:
-        cytoplasm_mask = np.logical_xor(cellmask, nucleus_obj)
+        nucleus_obj = np.logical_and(nuclei_object, cellmask)
+        # without opencv `binary_erosion_planes` is plain scipy, so large footprints go via FFT instead
+        if footprint.size > 27 and not opencv_available():
+            nucleus_obj = _binary_erosion_fft(nucleus_obj, footprint)
+        else:
+            nucleus_obj = binary_erosion_planes(nucleus_obj, footprint)
+
+        # for booleans `a > b` is `a & ~b`, so a single pass writes the uint16 mask directly
+        np.greater(cellmask, nucleus_obj, out=cytoplasm_mask)
 
-    return label_bool_as_uint16(cytoplasm_mask)
+    return cytoplasm_mask
 
 
 def infer_and_export_cytoplasm(
-    nuclei_object: np.ndarray, cellmask: np.ndarray, meta_dict: Dict, out_data_path: Path
+    nuclei_object: np.ndarray, cellmask: np.ndarray, meta_dict: Dict, out_data_path: Path, key: Union[str, None] = None
 ) -> np.ndarray:
     """
     infer nucleus and write inferred nuclei to ome.tif file
@@ -63,6 +257,8 @@ def infer_and_export_cytoplasm(
         dictionary of meta-data (ome)
     out_data_path:
         Path object where tiffs are written to
+    key:
+        optional content key of the inputs (see `content_key`), stored in the exported tiff's metadata
 
     Returns
     -------------
@@ -71,7 +267,7 @@ def infer_and_export_cytoplasm(
     """
     cytoplasm = infer_cytoplasm(nuclei_object, cellmask)
 
-    out_file_n = export_inferred_organelle(cytoplasm, "cyto", meta_dict, out_data_path)
+    out_file_n = export_inferred_organelle(cytoplasm, "cyto", meta_dict, out_data_path, key=key)
     print(f"inferred cytoplasm. wrote {out_file_n}")
     return cytoplasm
 
@@ -96,12 +292,15 @@ def get_cytoplasm(nuclei_obj: np.ndarray, cellmask: np.ndarray, meta_dict: Dict,
     exported file name
 
     """
+    # the canonical `{stem}-cyto.tiff` carries a content key of the nuclei and cellmask inputs in its metadata.
+    #   a file without a matching key (stale, or written before keys were stored) is re-inferred and overwritten
+    key = content_key(nuclei_obj, cellmask, salt="cyto")
     try:
-        cytoplasm = import_inferred_organelle("cyto", meta_dict, out_data_path)>0
+        cytoplasm = import_inferred_organelle("cyto", meta_dict, out_data_path, ".tiff", key=key)>0
     except:
         start = time.time()
         print("starting segmentation...")
-        cytoplasm = infer_and_export_cytoplasm(nuclei_obj, cellmask, meta_dict, out_data_path)
+        cytoplasm = infer_and_export_cytoplasm(nuclei_obj, cellmask, meta_dict, out_data_path, key=key)
         end = time.time()
         print(f"inferred cytoplasm in ({(end - start):0.2f}) sec")
 
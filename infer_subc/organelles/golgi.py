@@ -2,19 +2,23 @@ import numpy as np
 from typing import Dict, Optional
 from pathlib import Path
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 from aicssegmentation.core.seg_dot import dot_3d_wrapper, dot_2d_slice_by_slice_wrapper
-from aicssegmentation.core.utils import topology_preserving_thinning
 
 from infer_subc.constants import GOLGI_CH
-from infer_subc.core.file_io import export_inferred_organelle, import_inferred_organelle
+from infer_subc.core.file_io import export_inferred_organelle, import_inferred_organelle, content_key
 from infer_subc.core.img import (
     fill_and_filter_linear_size,
     select_channel_from_raw,
     masked_object_thresh,
     scale_and_smooth,
     label_uint16,
-    dot_filter_3
+    dot_filter_3,
+    to_backend,
+    to_numpy,
+    topology_preserving_thinning,
 )
 
 
@@ -41,7 +45,10 @@ def infer_golgi(
             min_hole_w: int,
             max_hole_w: int,
             small_obj_w: int,
-            fill_filter_method: str
+            fill_filter_method: str,
+            out: Optional[np.ndarray] = None,
+            backend: str = "numpy",
+            tile_z: Optional[int] = None
         ) -> np.ndarray:
 
     """
@@ -75,6 +82,16 @@ def infer_golgi(
         threshold for dot filter thresholds (1,2,and 3)
     small_obj_w: 
         minimu object size cutoff for nuclei post-processing
+    out:
+        optional preallocated np.uint16 array to write the labels into (e.g. reused across a batch)
+    backend:
+        "numpy" (default) or "cupy".  "cupy" runs the smoothing and dot filter on the GPU (requires cupy);
+        the masked object threshold, thinning and post-processing always run on the CPU
+    tile_z:
+        optional number of Z slices per tile (positive int, "numpy" backend only).  the smoothing and the
+        slice-by-slice dot filter have no extent along Z, so they are run tile by tile while the tile is still in
+        cache (no halo needed), with the tiles spread over a thread pool.  the threshold, thinning and
+        post-processing need the whole volume.  same result as untiled
     
     Returns
     -------------
@@ -82,27 +99,44 @@ def infer_golgi(
         mask defined extent of golgi object
     """
 
-    ###################
-    # EXTRACT
-    ###################    
-    golgi = select_channel_from_raw(in_img, golgi_ch)
+    if tile_z is not None:
+        if isinstance(tile_z, bool) or not isinstance(tile_z, (int, np.integer)) or tile_z < 1:
+            raise ValueError(f"tile_z must be a positive int, got {tile_z!r}")
+        if backend != "numpy":
+            raise ValueError(f"tile_z is only supported with the \"numpy\" backend, got backend={backend!r}")
+
+        golgi, bw_extra = _smooth_and_dot_tiled(select_channel_from_raw(in_img, golgi_ch),
+                                                median_sz, gauss_sig,
+                                                dot_scale_1, dot_cut_1, dot_scale_2, dot_cut_2, dot_scale_3, dot_cut_3,
+                                                dot_method, tile_z)
+    else:
+        ###################
+        # EXTRACT
+        ###################    
+        golgi = to_backend(select_channel_from_raw(in_img, golgi_ch), backend)
+
+        ###################
+        # PRE_PROCESSING
+        ###################    
+        golgi =  scale_and_smooth(golgi,
+                                  median_size = median_sz, 
+                                  gauss_sigma = gauss_sig)
+        ###################
+        # CORE_PROCESSING
+        ###################
+        # spot filter first, while the smoothed image is still on the `backend` device
+        bw_extra = dot_filter_3(golgi,
+                                dot_scale_1, dot_cut_1, dot_scale_2, dot_cut_2, dot_scale_3, dot_cut_3,
+                                dot_method)
+        bw_extra = to_numpy(bw_extra)
+        golgi = to_numpy(golgi)
 
-    ###################
-    # PRE_PROCESSING
-    ###################    
-    golgi =  scale_and_smooth(golgi,
-                              median_size = median_sz, 
-                              gauss_sigma = gauss_sig)
-    ###################
-    # CORE_PROCESSING
-    ###################
     bw = masked_object_thresh(golgi, global_method=mo_method, cutoff_size=mo_cutoff_size, local_adjust=mo_adjust)
 
     bw_thin = topology_preserving_thinning(bw, min_thickness, thin_dist)
 
-    bw_extra = dot_filter_3(golgi, dot_scale_1, dot_cut_1, dot_scale_2, dot_cut_2, dot_scale_3, dot_cut_3, dot_method)
-
-    bw = np.logical_or(bw_extra, bw_thin)
+    # bw_extra is a fresh array from the dot filter, so OR in place rather than allocating a third volume
+    bw = np.logical_or(bw_extra, bw_thin, out=bw_extra)
     ###################
     # POST_PROCESSING
     ###################
@@ -115,11 +149,58 @@ def infer_golgi(
     ###################
     # LABELING
     ###################
-    struct_obj1 = label_uint16(struct_obj)
+    struct_obj1 = label_uint16(struct_obj, out=out)
 
     return struct_obj1
 
 
+def _smooth_and_dot_tiled(
+    golgi: np.ndarray,
+    median_sz: int,
+    gauss_sig: float,
+    dot_scale_1: float,
+    dot_cut_1: float,
+    dot_scale_2: float,
+    dot_cut_2: float,
+    dot_scale_3: float,
+    dot_cut_3: float,
+    dot_method: str,
+    tile_z: int,
+):
+    """
+    `scale_and_smooth` + `dot_filter_3` for `infer_golgi`, one block of `tile_z` slices at a time.  the min-max
+    scaling uses the whole volume's range so the tiles match the untiled result exactly.  tiles write disjoint
+    slices of the outputs, so they run on one shared thread pool (each tile's dot filter is single threaded)
+
+    Returns
+    -------------
+        (smoothed golgi, dots) np.ndarrays
+    """
+    min_max = (golgi.min(), golgi.max())
+    smoothed = np.empty(golgi.shape, dtype=np.result_type(golgi.dtype, 1e-8))
+    bw_extra = np.empty(golgi.shape, dtype=bool)
+    dots_per_tile = dot_method == "slice_by_slice"
+
+    def _one_tile(tile):
+        scale_and_smooth(golgi[tile], median_size=median_sz, gauss_sigma=gauss_sig, out=smoothed[tile], min_max=min_max)
+        if dots_per_tile:
+            bw_extra[tile] = dot_filter_3(smoothed[tile],
+                                          dot_scale_1, dot_cut_1, dot_scale_2, dot_cut_2, dot_scale_3, dot_cut_3,
+                                          dot_method, workers=1)
+
+    tiles = [slice(z0, z0 + tile_z) for z0 in range(0, golgi.shape[0], tile_z)]
+    with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(tiles))) as pool:
+        # list() re-raises any exception from the tiles
+        list(pool.map(_one_tile, tiles))
+
+    if not dots_per_tile:
+        bw_extra = dot_filter_3(smoothed,
+                                dot_scale_1, dot_cut_1, dot_scale_2, dot_cut_2, dot_scale_3, dot_cut_3,
+                                dot_method)
+
+    return smoothed, bw_extra
+
+
 # def infer_golgi(
 #     in_img: np.ndarray,
 #     median_sz: int,
@@ -302,7 +383,9 @@ def fixed_infer_golgi(in_img: np.ndarray ) -> np.ndarray:
 #     )
 
 
-def infer_and_export_golgi(in_img: np.ndarray, meta_dict: Dict, out_data_path: Path) -> np.ndarray:
+def infer_and_export_golgi(
+    in_img: np.ndarray, meta_dict: Dict, out_data_path: Path, key: Optional[str] = None
+) -> np.ndarray:
     """
     infer golgi and write inferred golgi to ome.tif file
 
@@ -314,6 +397,8 @@ def infer_and_export_golgi(in_img: np.ndarray, meta_dict: Dict, out_data_path: P
         dictionary of meta-data (ome)
     out_data_path:
         Path object where tiffs are written to
+    key:
+        optional content key of the inputs (see `content_key`), stored in the exported tiff's metadata
 
     Returns
     -------------
@@ -321,7 +406,7 @@ def infer_and_export_golgi(in_img: np.ndarray, meta_dict: Dict, out_data_path: P
 
     """
     golgi = fixed_infer_golgi(in_img)
-    out_file_n = export_inferred_organelle(golgi, "golgi", meta_dict, out_data_path)
+    out_file_n = export_inferred_organelle(golgi, "golgi", meta_dict, out_data_path, key=key)
     print(f"inferred golgi. wrote {out_file_n}")
     return golgi
 
@@ -345,12 +430,15 @@ def get_golgi(in_img: np.ndarray, meta_dict: Dict, out_data_path: Path) -> np.nd
 
     """
 
+    # the canonical `{stem}-golgi.tiff` carries a content key of the input channel in its metadata.
+    #   a file without a matching key (stale, or written before keys were stored) is re-inferred and overwritten
+    key = content_key(select_channel_from_raw(in_img, GOLGI_CH), salt=f"golgi-{GOLGI_CH}")
     try:
-        golgi = import_inferred_organelle("golgi", meta_dict, out_data_path)
+        golgi = import_inferred_organelle("golgi", meta_dict, out_data_path, ".tiff", key=key)
     except:
         start = time.time()
         print("starting segmentation...")
-        golgi = infer_and_export_golgi(in_img, meta_dict, out_data_path)
+        golgi = infer_and_export_golgi(in_img, meta_dict, out_data_path, key=key)
         end = time.time()
         print(f"inferred (and exported) golgi in ({(end - start):0.2f}) sec")
 
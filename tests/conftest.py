@@ -1,5 +1,10 @@
 import sys
 import pytest
+from skimage.morphology import medial_axis
+
+import aicssegmentation.core.utils as aics_utils
+
+from infer_subc.core import img
 
 
 # each test runs on cwd to its temp dir
@@ -12,3 +17,18 @@ def go_to_tmpdir(request):
     # Chdir only for the duration of the test.
     with tmpdir.as_cwd():
         yield
+
+
+def _seeded_medial_axis(image, **kwargs):
+    """medial_axis breaks ties randomly; seed it so repeated runs agree"""
+    try:
+        return medial_axis(image, rng=0)
+    except TypeError:  # scikit-image < 0.19
+        return medial_axis(image, random_state=0)
+
+
+# thinning (ours and aicssegmentation's) with a deterministic medial axis
+@pytest.fixture
+def seeded_medial_axis(monkeypatch):
+    monkeypatch.setattr(aics_utils, "medial_axis", _seeded_medial_axis)
+    monkeypatch.setattr(img, "medial_axis", _seeded_medial_axis)
@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from skimage.morphology import ball, binary_erosion
+
+from infer_subc.core.file_io import content_key, export_inferred_organelle, read_tiff_content_key
+from infer_subc.core import img
+from infer_subc.core.img import apply_mask
+from infer_subc.organelles import cytoplasm
+from infer_subc.organelles.cytoplasm import infer_cytoplasm
+
+
+def _baseline_cytoplasm(nuclei_object, cellmask, erode_nuclei, footprint):
+    """the original `infer_cytoplasm`: cellmask XOR (eroded) masked nuclei"""
+    nucleus_obj = apply_mask(nuclei_object, cellmask)
+    if erode_nuclei:
+        if footprint is None:
+            nucleus_obj = binary_erosion(nucleus_obj)
+        else:
+            nucleus_obj = binary_erosion(nucleus_obj, footprint=footprint)
+    return np.logical_xor(cellmask, nucleus_obj)
+
+
+@pytest.fixture
+def nuclei_and_cellmask():
+    rng = np.random.default_rng(0)
+    # labeled nuclei (> 1) partly outside a blocky cellmask, so the masking
+    #   before the erosion matters.  x is not a multiple of 64 (bit packing)
+    nuclei = (rng.random((9, 40, 70)) > 0.15).astype(np.uint16) * 2
+    cellmask = np.zeros(nuclei.shape, dtype=bool)
+    cellmask[1:8, 5:35, 3:60] = True
+    cellmask |= rng.random(nuclei.shape) > 0.9
+    return nuclei, cellmask
+
+
+@pytest.mark.parametrize("use_numba", [True, False])
+@pytest.mark.parametrize("erode_nuclei", [True, False])
+@pytest.mark.parametrize("footprint", [None, ball(1), ball(2)])
+def test_infer_cytoplasm_matches_baseline(monkeypatch, nuclei_and_cellmask, use_numba, erode_nuclei, footprint):
+    if use_numba and cytoplasm.njit is None:
+        pytest.skip("numba not installed")
+    if not use_numba:
+        # numpy fallback: bit-packed cross erosion
+        monkeypatch.setattr(cytoplasm, "njit", None)
+
+    nuclei, cellmask = nuclei_and_cellmask
+    expected = _baseline_cytoplasm(nuclei, cellmask, erode_nuclei, footprint)
+    cyto = infer_cytoplasm(nuclei, cellmask, erode_nuclei, footprint)
+
+    assert cyto.dtype == np.uint16
+    np.testing.assert_array_equal(cyto > 0, expected)
+
+
+@pytest.mark.parametrize("use_cv2", [True, False])
+def test_infer_cytoplasm_large_footprint(monkeypatch, nuclei_and_cellmask, use_cv2):
+    if use_cv2 and not img.opencv_available():
+        pytest.skip("opencv not installed")
+    if not use_cv2:
+        # FFT erosion
+        monkeypatch.setattr(img, "cv2", None)
+
+    nuclei, cellmask = nuclei_and_cellmask
+    expected = _baseline_cytoplasm(nuclei, cellmask, True, ball(2))
+    cyto = infer_cytoplasm(nuclei, cellmask, footprint=ball(2))
+
+    np.testing.assert_array_equal(cyto > 0, expected)
+
+
+def test_infer_cytoplasm_out(nuclei_and_cellmask):
+    nuclei, cellmask = nuclei_and_cellmask
+    out = np.empty(nuclei.shape, dtype=np.uint16)
+    cyto = infer_cytoplasm(nuclei, cellmask, out=out)
+
+    assert cyto is out
+    np.testing.assert_array_equal(out > 0, _baseline_cytoplasm(nuclei, cellmask, True, None))
+
+
+@pytest.mark.parametrize("n_z", [1, 5, 120])
+@pytest.mark.parametrize("spans_z", [True, False])
+def test_erode_policy_auto_erodes_loose_nuclei(n_z, spans_z):
+    # a single small nucleus: a large share of its voxels are on the XY rim, even when it runs through every slice
+    nuclei = np.zeros((n_z, 60, 60), dtype=bool)
+    nuclei[0 if spans_z else n_z // 2 :, 10:50, 10:50] = True
+    cellmask = np.ones_like(nuclei)
+
+    eroded = infer_cytoplasm(nuclei, cellmask, erode_policy="always")
+    auto = infer_cytoplasm(nuclei, cellmask, erode_policy="auto")
+
+    np.testing.assert_array_equal(auto, eroded)
+
+
+def test_erode_policy_auto_skips_tight_nuclei():
+    # one nucleus filling nearly the whole volume: the erosion only touches a thin rim
+    nuclei = np.zeros((4, 400, 400), dtype=bool)
+    nuclei[:, 1:399, 1:399] = True
+    cellmask = np.ones_like(nuclei)
+
+    auto = infer_cytoplasm(nuclei, cellmask, erode_policy="auto")
+
+    np.testing.assert_array_equal(auto, infer_cytoplasm(nuclei, cellmask, erode_policy="never"))
+
+
+def test_erode_policy_overrides_erode_nuclei(nuclei_and_cellmask):
+    nuclei, cellmask = nuclei_and_cellmask
+    np.testing.assert_array_equal(
+        infer_cytoplasm(nuclei, cellmask, True, erode_policy="never"),
+        infer_cytoplasm(nuclei, cellmask, False),
+    )
+    np.testing.assert_array_equal(
+        infer_cytoplasm(nuclei, cellmask, False, erode_policy="always"),
+        infer_cytoplasm(nuclei, cellmask, True),
+    )
+    with pytest.raises(ValueError):
+        infer_cytoplasm(nuclei, cellmask, erode_policy="sometimes")
+
+
+def test_get_cytoplasm_cache_is_keyed_on_content(tmp_path, nuclei_and_cellmask):
+    nuclei, cellmask = nuclei_and_cellmask
+    other_nuclei = np.roll(nuclei, 5, axis=2)
+    meta_dict = {"file_name": "img.czi"}
+    cyto_file = tmp_path / "img-cyto.tiff"
+
+    first = cytoplasm.get_cytoplasm(nuclei, cellmask, meta_dict, tmp_path)
+    # written under the canonical name that the batch utilities look up, and nothing else
+    assert [f.name for f in tmp_path.iterdir()] == [cyto_file.name]
+    assert read_tiff_content_key(cyto_file) == content_key(nuclei, cellmask, salt="cyto")
+
+    # the canonical file is stale for other inputs: re-inferred and overwritten
+    second = cytoplasm.get_cytoplasm(other_nuclei, cellmask, meta_dict, tmp_path)
+    np.testing.assert_array_equal(second, infer_cytoplasm(other_nuclei, cellmask) > 0)
+    assert not np.array_equal(first, second)
+    assert read_tiff_content_key(cyto_file) == content_key(other_nuclei, cellmask, salt="cyto")
+
+    # a matching file is loaded rather than re-inferred
+    mtime = cyto_file.stat().st_mtime_ns
+    reloaded = cytoplasm.get_cytoplasm(other_nuclei, cellmask, meta_dict, tmp_path)
+    np.testing.assert_array_equal(reloaded, second)
+    assert cyto_file.stat().st_mtime_ns == mtime
+
+
+def test_get_cytoplasm_reinfers_file_without_key(tmp_path, nuclei_and_cellmask):
+    nuclei, cellmask = nuclei_and_cellmask
+    meta_dict = {"file_name": "img.czi"}
+    # e.g. written by `infer_and_export_cytoplasm` without a key, from other inputs
+    export_inferred_organelle(np.zeros(nuclei.shape, dtype=bool), "cyto", meta_dict, tmp_path)
+
+    cyto = cytoplasm.get_cytoplasm(nuclei, cellmask, meta_dict, tmp_path)
+    np.testing.assert_array_equal(cyto, infer_cytoplasm(nuclei, cellmask) > 0)
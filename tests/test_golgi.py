@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from infer_subc.organelles.golgi import infer_golgi
+
+GOLGI_PARAMS = dict(
+    golgi_ch=0,
+    median_sz=3,
+    gauss_sig=1.34,
+    mo_method="tri",
+    mo_adjust=1.0,
+    mo_cutoff_size=50,
+    min_thickness=1.6,
+    thin_dist=1,
+    dot_scale_1=1.6,
+    dot_cut_1=0.02,
+    dot_scale_2=0,
+    dot_cut_2=0,
+    dot_scale_3=0,
+    dot_cut_3=0,
+    dot_method="slice_by_slice",
+    min_hole_w=0,
+    max_hole_w=0,
+    small_obj_w=3,
+    fill_filter_method="3D",
+)
+
+
+@pytest.fixture
+def golgi_img():
+    rng = np.random.default_rng(0)
+    raw = ndimage.gaussian_filter(rng.random((1, 7, 64, 64)), (0, 0, 2, 2))
+    return (raw * 4000).astype(np.uint16)
+
+
+@pytest.mark.parametrize("tile_z", [1, 3, 7, 20])
+def test_infer_golgi_tiled_matches_untiled(seeded_medial_axis, golgi_img, tile_z):
+    expected = infer_golgi(golgi_img, **GOLGI_PARAMS)
+    tiled = infer_golgi(golgi_img, **GOLGI_PARAMS, tile_z=tile_z)
+    np.testing.assert_array_equal(tiled, expected)
+
+
+@pytest.mark.parametrize("tile_z", [0, -2, 2.5, True, "4"])
+def test_infer_golgi_rejects_bad_tile_z(golgi_img, tile_z):
+    with pytest.raises(ValueError, match="tile_z"):
+        infer_golgi(golgi_img, **GOLGI_PARAMS, tile_z=tile_z)
+
+
+def test_infer_golgi_tile_z_requires_numpy_backend(golgi_img):
+    with pytest.raises(ValueError, match="backend"):
+        infer_golgi(golgi_img, **GOLGI_PARAMS, backend="cupy", tile_z=2)
@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from skimage.morphology import ball
+
+import aicssegmentation.core.utils as aics_utils
+from aicssegmentation.core.MO_threshold import MO
+from aicssegmentation.core.pre_processing_utils import (
+    image_smoothing_gaussian_slice_by_slice,
+)
+from aicssegmentation.core.seg_dot import (
+    dot_2d_slice_by_slice_wrapper,
+    dot_3d_wrapper,
+)
+
+from infer_subc.core import img
+from infer_subc.core.img import (
+    binary_erosion_planes,
+    dot_2d_slice_by_slice,
+    dot_3d,
+    label_uint16,
+    masked_object_thresh,
+    median_filter_slice_by_slice,
+    min_max_intensity_normalization,
+    scale_and_smooth,
+    size_filter,
+    topology_preserving_thinning,
+)
+
+
+@pytest.fixture
+def smooth_img():
+    rng = np.random.default_rng(0)
+    raw = ndimage.gaussian_filter(rng.random((12, 96, 100)), (0, 2, 2))
+    return min_max_intensity_normalization(raw)
+
+
+@pytest.fixture
+def blobs(smooth_img):
+    return smooth_img > 0.55
+
+
+def _reference_size_filter(bw, min_size, method, connectivity):
+    """remove components smaller than min_size, labeling slice by slice"""
+
+    def _filter(plane):
+        structure = ndimage.generate_binary_structure(plane.ndim, connectivity)
+        labels, _ = ndimage.label(plane, structure)
+        too_small = np.bincount(labels.ravel()) < min_size
+        too_small[0] = False
+        return plane & ~too_small[labels]
+
+    if method == "3D":
+        return _filter(bw)
+    return np.stack([_filter(plane) for plane in bw])
+
+
+@pytest.mark.parametrize(
+    "method, cutoff_size, local_adjust",
+    [("tri", 50, 1.0), ("ave", 20, 0.9), ("med", 100, 1.1)],
+)
+def test_masked_object_thresh_matches_aics(smooth_img, method, cutoff_size, local_adjust):
+    expected = MO(
+        smooth_img,
+        object_minArea=cutoff_size,
+        global_thresh_method=method,
+        extra_criteria=True,
+        local_adjust=local_adjust,
+        return_object=False,
+        dilate=False,
+    )
+    bw = masked_object_thresh(smooth_img, method, cutoff_size, local_adjust)
+    np.testing.assert_array_equal(bw, expected)
+
+
+@pytest.mark.parametrize("median_size", [1, 3])
+def test_scale_and_smooth_matches_slice_by_slice(median_size):
+    rng = np.random.default_rng(1)
+    raw = (rng.random((6, 50, 60)) * 4000).astype(np.uint16)
+
+    expected = min_max_intensity_normalization(raw)
+    if median_size > 1:
+        expected = median_filter_slice_by_slice(expected, size=median_size)
+    expected = image_smoothing_gaussian_slice_by_slice(expected, sigma=1.34)
+
+    smoothed = scale_and_smooth(raw, median_size=median_size)
+    np.testing.assert_array_equal(smoothed, expected)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_dot_2d_slice_by_slice_matches_aics(smooth_img, workers):
+    s_param = [[1.5, 0.01], [2.5, 0.005]]
+    expected = dot_2d_slice_by_slice_wrapper(smooth_img, s_param)
+    bw = dot_2d_slice_by_slice(smooth_img, s_param, workers)
+    # float32 responses: only voxels sitting on the cutoff may flip
+    assert np.count_nonzero(bw != expected) <= 1e-4 * bw.size
+
+
+def test_dot_3d_matches_aics(smooth_img):
+    s_param = [[1.0, 0.01], [2.0, 0.005]]
+    expected = dot_3d_wrapper(smooth_img, s_param)
+    bw = dot_3d(smooth_img, s_param)
+    assert np.count_nonzero(bw != expected) <= 1e-4 * bw.size
+
+
+@pytest.mark.parametrize("min_thickness, thin", [(1, 1), (2, 1), (1, 2)])
+def test_topology_preserving_thinning_matches_aics(seeded_medial_axis, blobs, min_thickness, thin):
+    expected = aics_utils.topology_preserving_thinning(blobs.copy(), min_thickness, thin)
+    bw = topology_preserving_thinning(blobs, min_thickness, thin)
+    np.testing.assert_array_equal(bw, expected)
+
+
+def test_topology_preserving_thinning_empty():
+    bw = np.zeros((3, 10, 10), dtype=bool)
+    assert not topology_preserving_thinning(bw).any()
+
+
+@pytest.mark.parametrize("method", ["3D", "slice_by_slice"])
+@pytest.mark.parametrize("connectivity", [1, 2])
+@pytest.mark.parametrize("min_size", [0, 4, 30])
+def test_size_filter(blobs, method, connectivity, min_size):
+    rng = np.random.default_rng(2)
+    bw = blobs & (rng.random(blobs.shape) > 0.3)
+    expected = _reference_size_filter(bw, min_size, method, connectivity)
+    np.testing.assert_array_equal(size_filter(bw, min_size, method, connectivity), expected)
+
+
+# without opencv `binary_erosion_planes` is scipy itself, so the `cv2.erode` anchor and border handling go untested
+@pytest.mark.skipif(not img.opencv_available(), reason="opencv not installed")
+@pytest.mark.parametrize("footprint", [ball(1), ball(2), np.ones((3, 5, 4))])
+def test_binary_erosion_planes(blobs, footprint):
+    expected = ndimage.binary_erosion(blobs, structure=footprint, border_value=1)
+    np.testing.assert_array_equal(binary_erosion_planes(blobs, footprint), expected)
+
+
+def test_label_uint16(blobs):
+    labels = label_uint16(blobs)
+    expected, _ = ndimage.label(blobs, ndimage.generate_binary_structure(3, 3))
+    assert labels.dtype == np.uint16
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_label_uint16_too_many_objects():
+    bw = np.zeros((1, 600, 600), dtype=bool)
+    bw[:, ::2, ::2] = True
+    with pytest.raises(ValueError, match="90000 objects"):
+        label_uint16(bw)